@@ -24,7 +24,17 @@ import struct
 import sys
 import time
 
+try:
+    import ssl
+except ImportError:
+    ssl = None
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
+
 import dns.exception
+import dns.flags
 import dns.inet
 import dns.name
 import dns.message
@@ -38,6 +48,38 @@ if PY3:
 else:
     select_error = select.error
 
+# Flag which makes a single send or receive non-blocking even on a
+# blocking socket, on platforms which have one.
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+# Precompiled format for the two byte length which precedes each DNS
+# message sent over TCP.
+_tcp_length = struct.Struct("!H")
+
+# Precompiled formats for the ID, and the ID and flags, which begin every
+# message.  The ID has the same format as the TCP length, so the same
+# object serves for both.
+_id = _tcp_length
+_id_and_flags = struct.Struct("!HH")
+
+# Wire formats of recently sent queries, keyed by everything which goes
+# into rendering a query except its ID; see _query_wire().  When the cache
+# is full it is simply emptied.
+_query_wire_cache = {}
+_query_wire_cache_size = 1024
+
+# memoryview(), which _TCPMessageReader needs, is new in Python 2.7.
+try:
+    memoryview
+    _have_memoryview = True
+except NameError:
+    _have_memoryview = False
+
+# Clock used for timekeeping which is never compared with the absolute
+# expiration times of the public API; monotonic where possible, so that it
+# is immune to changes of the system time.
+_monotonic = getattr(time, 'monotonic', time.time)
+
 # Function used to create a socket.  Can be overridden if needed in special
 # situations.
 socket_factory = socket.socket
@@ -59,11 +101,14 @@ class TransferError(dns.exception.DNSException):
         self.rcode = rcode
 
 
-def _compute_expiration(timeout):
+def _compute_expiration(timeout, now=None):
+    # *now*, if given, is a time the caller has already read from the clock.
     if timeout is None:
         return None
-    else:
+    elif now is None:
         return time.time() + timeout
+    else:
+        return now + timeout
 
 # This module can use either poll() or select() as the "polling backend".
 #
@@ -158,16 +203,65 @@ def _wait_for_writable(s, expiration):
     _wait_for(s, False, True, True, expiration)
 
 
-def _addresses_equal(af, a1, a2):
-    # Convert the first value of the tuple, which is a textual format
-    # address into binary form, so that we are not confused by different
-    # textual representations of the same address
+def _dontwait_flags(sock):
+    # Return the flags for a send or receive on *sock* which must not
+    # block, or 0 if it cannot be done, in which case the caller must wait
+    # for the socket instead.  TLS sockets refuse any flags.
+    if ssl is not None and isinstance(sock, ssl.SSLSocket):
+        return 0
+    return _MSG_DONTWAIT
+
+
+def _would_block(e):
+    # Is the socket error *e* the one raised by a non-blocking operation
+    # which could not be completed straight away?
+    return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def _address_is(af, text, packed):
+    # Is the textual format address *text* the binary format address
+    # *packed*?  Comparing binary forms means we are not confused by
+    # different textual representations of the same address.
     try:
-        n1 = dns.inet.inet_pton(af, a1[0])
-        n2 = dns.inet.inet_pton(af, a2[0])
+        return dns.inet.inet_pton(af, text) == packed
     except dns.exception.SyntaxError:
         return False
-    return n1 == n2 and a1[1:] == a2[1:]
+
+
+def _matches_header(wire, query_id):
+    # Check just the fixed header of a received message to see if it could
+    # be a response to the query with ID *query_id*, so that messages which
+    # cannot be are discarded without the cost of parsing them.
+    if len(wire) < 12:
+        return False
+    (id, flags) = _id_and_flags.unpack_from(wire)
+    return id == query_id and flags & dns.flags.QR != 0
+
+
+def _query_wire(q):
+    # Return the wire format of the query *q*.
+    #
+    # Applications tend to send the same few questions over and over, and
+    # rendering a message is comparatively expensive, so a plain query's
+    # wire format is cached, and later queries asking the same question in
+    # the same way reuse it with just their own ID patched in.  Names are
+    # keyed by their labels, not by dns.name.Name, since names which
+    # compare equal may differ in case.  Signed queries, queries with EDNS
+    # options, and queries with records are always rendered afresh.
+    if q.keyname is not None or q.options or q.answer or q.authority or \
+       q.additional:
+        return q.to_wire()
+    key = (tuple((rrset.name.labels, rrset.rdtype, rrset.rdclass)
+                 for rrset in q.question),
+           q.flags, q.edns, q.ednsflags, q.payload, q.request_payload)
+    wire = _query_wire_cache.get(key)
+    if wire is not None:
+        return _id.pack(q.id) + wire[2:]
+    wire = q.to_wire()
+    if len(_query_wire_cache) >= _query_wire_cache_size:
+        _query_wire_cache.clear()
+    _query_wire_cache[key] = wire
+    return wire
 
 
 def _destination_and_source(af, where, port, source, source_port):
@@ -212,6 +306,20 @@ def send_udp(sock, what, destination, expiration=None):
 
     if isinstance(what, dns.message.Message):
         what = what.to_wire()
+    flags = _dontwait_flags(sock)
+    if flags:
+        # A UDP socket is almost always writable, so try sending straight
+        # away and only wait for the socket if that would block.
+        sent_time = time.time()
+        try:
+            n = sock.sendto(what, flags, destination)
+            return (n, sent_time)
+        except socket.error as e:
+            if not _would_block(e):
+                raise
+        except ValueError:
+            # The socket does not accept flags; wait for it instead.
+            pass
     _wait_for_writable(sock, expiration)
     sent_time = time.time()
     n = sock.sendto(what, destination)
@@ -220,7 +328,7 @@ def send_udp(sock, what, destination, expiration=None):
 
 def receive_udp(sock, destination, expiration=None,
                 ignore_unexpected=False, one_rr_per_rrset=False,
-                keyring=None, request_mac=b''):
+                keyring=None, request_mac=b'', expected_id=None):
     """Read a DNS message from a UDP socket.
 
     *sock*, a ``socket``.
@@ -242,24 +350,67 @@ def receive_udp(sock, destination, expiration=None,
 
     *request_mac*, a ``binary``, the MAC of the request (for TSIG).
 
+    *expected_id*, an ``int`` or ``None``, the ID of the associated query.
+    If not ``None``, a message which does not have this ID or which is not
+    a response is rejected by checking its header, without parsing it.  If
+    *ignore_unexpected* is ``True`` such messages are ignored, otherwise
+    ``dns.query.BadResponse`` is raised.
+
     Raises if the message is malformed, if network errors occur, of if
     there is a timeout.
 
     Returns a ``dns.message.Message`` object.
     """
 
+    # Work out how to recognize datagrams from the destination once, rather
+    # than for every datagram received.  Usually the source address comes
+    # back exactly as the destination was given, and that check is cheap.
+    try:
+        destination_address = dns.inet.inet_pton(sock.family, destination[0])
+    except dns.exception.SyntaxError:
+        destination_address = None
+    multicast = dns.inet.is_multicast(destination[0])
     wire = b''
+    flags = 0
     while 1:
-        _wait_for_readable(sock, expiration)
-        (wire, from_address) = sock.recvfrom(65535)
-        if _addresses_equal(sock.family, from_address, destination) or \
-           (dns.inet.is_multicast(destination[0]) and
-            from_address[1:] == destination[1:]):
+        if flags == 0:
+            _wait_for_readable(sock, expiration)
+        elif expiration is not None and time.time() >= expiration:
+            # Draining does not wait on the socket, so time must be checked
+            # here, or a flood of unexpected datagrams would keep us going.
+            raise dns.exception.Timeout
+        try:
+            if flags == 0:
+                (wire, from_address) = sock.recvfrom(65535)
+            else:
+                (wire, from_address) = sock.recvfrom(65535, flags)
+        except socket.error as e:
+            if flags == 0 or not _would_block(e):
+                raise
+            # We have drained the socket; wait for more.
+            flags = 0
+            continue
+        except ValueError:
+            if flags == 0:
+                raise
+            # The socket does not accept flags; wait for it instead.
+            flags = 0
+            continue
+        if not (from_address == destination or
+                (from_address[1:] == destination[1:] and
+                 (multicast or _address_is(sock.family, from_address[0],
+                                           destination_address)))):
+            if not ignore_unexpected:
+                raise UnexpectedSource('got a response from '
+                                       '%s instead of %s' % (from_address,
+                                                             destination))
+        elif expected_id is None or _matches_header(wire, expected_id):
             break
-        if not ignore_unexpected:
-            raise UnexpectedSource('got a response from '
-                                   '%s instead of %s' % (from_address,
-                                                         destination))
+        elif not ignore_unexpected:
+            raise BadResponse
+        # Any other datagrams which have already arrived can be read
+        # straight away, without waiting for the socket again.
+        flags = _dontwait_flags(sock)
     received_time = time.time()
     r = dns.message.from_wire(wire, keyring=keyring, request_mac=request_mac,
                               one_rr_per_rrset=one_rr_per_rrset)
@@ -299,7 +450,7 @@ def udp(q, where, timeout=None, port=53, af=None, source=None, source_port=0,
     Returns a ``dns.message.Message``.
     """
 
-    wire = q.to_wire()
+    wire = _query_wire(q)
     (af, destination, source) = _destination_and_source(af, where, port,
                                                         source, source_port)
     s = socket_factory(af, socket.SOCK_DGRAM, 0)
@@ -313,7 +464,7 @@ def udp(q, where, timeout=None, port=53, af=None, source=None, source_port=0,
         (_, sent_time) = send_udp(s, wire, destination, expiration)
         (r, received_time) = receive_udp(s, destination, expiration,
                                          ignore_unexpected, one_rr_per_rrset,
-                                         q.keyring, q.mac)
+                                         q.keyring, q.mac, q.id)
     finally:
         if sent_time is None or received_time is None:
             response_time = 0
@@ -332,15 +483,35 @@ def _net_read(sock, count, expiration):
     A Timeout exception will be raised if the operation is not completed
     by the expiration time.
     """
-    s = b''
+    chunks = []
+    # Try the first read straight away, as the data has often already
+    # arrived, and only wait for the socket to become readable (working
+    # out how long we may wait) if that would block or the read was short.
+    flags = _dontwait_flags(sock)
     while count > 0:
-        _wait_for_readable(sock, expiration)
-        n = sock.recv(count)
+        if not flags:
+            _wait_for_readable(sock, expiration)
+        try:
+            n = sock.recv(count, flags)
+        except socket.error as e:
+            if not flags or not _would_block(e):
+                raise
+            flags = 0
+            continue
+        except ValueError:
+            # The socket does not accept flags; wait for it instead.
+            if not flags:
+                raise
+            flags = 0
+            continue
         if n == b'':
             raise EOFError
         count = count - len(n)
-        s = s + n
-    return s
+        chunks.append(n)
+        flags = 0
+    if len(chunks) == 1:
+        return chunks[0]
+    return b''.join(chunks)
 
 
 def _net_write(sock, data, expiration):
@@ -350,9 +521,133 @@ def _net_write(sock, data, expiration):
     """
     current = 0
     l = len(data)
+    # Try the first send straight away, and only wait for the socket to
+    # become writable if that would block or the send was short.
+    flags = _dontwait_flags(sock)
     while current < l:
-        _wait_for_writable(sock, expiration)
-        current += sock.send(data[current:])
+        if not flags:
+            _wait_for_writable(sock, expiration)
+        try:
+            current += sock.send(data[current:], flags)
+        except socket.error as e:
+            if not flags or not _would_block(e):
+                raise
+        except ValueError:
+            # The socket does not accept flags; wait for it instead.
+            if not flags:
+                raise
+        flags = 0
+
+
+def _sendmsg(sock, buffers, expiration):
+    # Gather write *buffers* to the socket with a single sendmsg(), trying
+    # it straight away and only waiting for the socket if that would block.
+    flags = _dontwait_flags(sock)
+    if flags:
+        try:
+            return sock.sendmsg(buffers, [], flags)
+        except socket.error as e:
+            if not _would_block(e):
+                raise
+    _wait_for_writable(sock, expiration)
+    return sock.sendmsg(buffers)
+
+
+def _net_write_message(sock, wire, expiration):
+    """Write the specified DNS message to the socket, preceded by its
+    two byte length as TCP requires.
+    A Timeout exception will be raised if the operation is not completed
+    by the expiration time.
+    """
+    header = _tcp_length.pack(len(wire))
+    n = None
+    if hasattr(sock, 'sendmsg'):
+        try:
+            n = _sendmsg(sock, [header, wire], expiration)
+        except NotImplementedError:
+            # Some sockets, e.g. ssl.SSLSocket, have a sendmsg() which
+            # refuses to do a gather write.
+            pass
+    if n is None:
+        # Without a gather write, send a copy of the wire with the length
+        # prepended rather than doing a short write of just the length,
+        # which would get pushed onto the net on its own.
+        _net_write(sock, header + wire, expiration)
+    elif n < 2:
+        _net_write(sock, header[n:] + wire, expiration)
+    else:
+        _net_write(sock, memoryview(wire)[n - 2:], expiration)
+
+
+class _TCPMessageReader(object):
+    """Reads a stream of DNS messages from a TCP socket, e.g. a zone
+    transfer.
+
+    Rather than reading each message's two byte length and then its body
+    separately, the reader receives whatever has arrived into a fixed
+    buffer, and keeps anything beyond the current message for the next
+    one.  Usually one recv() then covers a length, its message, and the
+    start of the following message.  Each message is copied out of the
+    buffer once, as the ``binary`` that ``dns.message.from_wire()`` needs.
+    """
+
+    # The buffer holds several of the largest possible messages, so that
+    # the unread data only occasionally has to be moved to its front.
+    bufsize = 4 * 65536
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray(self.bufsize)
+        self.view = memoryview(self.buf)
+        # The unread data is buf[start:end].
+        self.start = 0
+        self.end = 0
+
+    def _fill(self, expiration):
+        # Receive whatever has arrived after the unread data, waiting for
+        # the socket only if nothing has.
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start > self.bufsize - 65537:
+            # The message being read might not fit after the unread data,
+            # so move it to the front of the buffer.
+            pending = self.end - self.start
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        n = None
+        flags = _dontwait_flags(self.sock)
+        if flags:
+            try:
+                n = self.sock.recv_into(self.view[self.end:], 0, flags)
+            except socket.error as e:
+                if not _would_block(e):
+                    raise
+            except ValueError:
+                # The socket does not accept flags; wait for it instead.
+                pass
+        if n is None:
+            _wait_for_readable(self.sock, expiration)
+            n = self.sock.recv_into(self.view[self.end:])
+        if n == 0:
+            raise EOFError
+        self.end += n
+
+    def read(self, expiration=None):
+        """Read the next message.
+        A Timeout exception will be raised if the operation is not completed
+        by the expiration time.
+
+        Returns a ``binary``, the wire format of the message.
+        """
+        while self.end - self.start < 2:
+            self._fill(expiration)
+        (l,) = _tcp_length.unpack_from(self.buf, self.start)
+        while self.end - self.start < l + 2:
+            self._fill(expiration)
+        wire = self.view[self.start + 2:self.start + 2 + l].tobytes()
+        self.start += l + 2
+        return wire
 
 
 def send_tcp(sock, what, expiration=None):
@@ -371,15 +666,10 @@ def send_tcp(sock, what, expiration=None):
 
     if isinstance(what, dns.message.Message):
         what = what.to_wire()
-    l = len(what)
-    # copying the wire into tcpmsg is inefficient, but lets us
-    # avoid writev() or doing a short write that would get pushed
-    # onto the net
-    tcpmsg = struct.pack("!H", l) + what
     _wait_for_writable(sock, expiration)
     sent_time = time.time()
-    _net_write(sock, tcpmsg, expiration)
-    return (len(tcpmsg), sent_time)
+    _net_write_message(sock, what, expiration)
+    return (len(what) + 2, sent_time)
 
 def receive_tcp(sock, expiration=None, one_rr_per_rrset=False,
                 keyring=None, request_mac=b''):
@@ -405,13 +695,125 @@ def receive_tcp(sock, expiration=None, one_rr_per_rrset=False,
     """
 
     ldata = _net_read(sock, 2, expiration)
-    (l,) = struct.unpack("!H", ldata)
+    (l,) = _tcp_length.unpack(ldata)
     wire = _net_read(sock, l, expiration)
     received_time = time.time()
     r = dns.message.from_wire(wire, keyring=keyring, request_mac=request_mac,
                               one_rr_per_rrset=one_rr_per_rrset)
     return (r, received_time)
 
+
+class ConnectionPool(object):
+    """Thread-safe pool of idle TCP connections, for reuse by
+    ``dns.query.tcp()``.
+
+    Opening a TCP connection costs a round trip before the query can
+    even be sent.  When many queries are made to the same server, a pool
+    lets each query reuse a connection left open by an earlier one, as
+    recommended by RFC 7766.  Connections which have been idle for longer
+    than the pool's maximum idle time are closed rather than reused.
+    """
+
+    def __init__(self, max_idle=10.0):
+        """*max_idle*, a ``float``, the number of seconds a connection may
+        stay idle in the pool before it is closed.
+        """
+
+        self.max_idle = max_idle
+        self.data = {}
+        self.next_expiration = None
+        self.lock = _threading.Lock()
+
+    def _close_expired(self, now):
+        # Close every connection idle for too long.  The lock must be held.
+        #
+        # The pool is only swept once its earliest expiration time has
+        # passed, so most calls cost a single comparison rather than a
+        # walk over every idle connection.
+        if self.next_expiration is None or now < self.next_expiration:
+            return
+        next_expiration = None
+        for key in list(self.data.keys()):
+            idle = self.data[key]
+            fresh = []
+            for (s, expiration) in idle:
+                if expiration <= now:
+                    s.close()
+                else:
+                    fresh.append((s, expiration))
+                    if next_expiration is None or \
+                       expiration < next_expiration:
+                        next_expiration = expiration
+            if not fresh:
+                del self.data[key]
+            elif len(fresh) != len(idle):
+                self.data[key] = fresh
+        self.next_expiration = next_expiration
+
+    def acquire(self, af, destination, source=None):
+        """Take an idle connection out of the pool.
+
+        *af*, an ``int``, the address family of the connection.
+
+        *destination*, a destination tuple appropriate for the address
+        family, specifying the server the connection is to.
+
+        *source*, a source tuple appropriate for the address family, or
+        ``None``, specifying the local address the connection is bound to.
+
+        Returns a connected ``socket``, or ``None`` if no suitable idle
+        connection is available.
+        """
+
+        try:
+            self.lock.acquire()
+            self._close_expired(_monotonic())
+            idle = self.data.get((af, destination, source))
+            if not idle:
+                return None
+            (s, _) = idle.pop()
+            if not idle:
+                del self.data[(af, destination, source)]
+            return s
+        finally:
+            self.lock.release()
+
+    def release(self, af, destination, source, sock):
+        """Return a connection to the pool so later queries can reuse it.
+
+        *af*, *destination*, and *source* are as for ``acquire()``.
+
+        *sock*, a ``socket``, the connection.  It must not have any
+        unread response data pending.
+        """
+
+        try:
+            self.lock.acquire()
+            now = _monotonic()
+            self._close_expired(now)
+            expiration = now + self.max_idle
+            self.data.setdefault((af, destination, source), []).append(
+                (sock, expiration))
+            if self.next_expiration is None or \
+               expiration < self.next_expiration:
+                self.next_expiration = expiration
+        finally:
+            self.lock.release()
+
+    def close_idle(self):
+        """Close all of the connections in the pool."""
+
+        try:
+            self.lock.acquire()
+            for idle in self.data.values():
+                for (s, _) in idle:
+                    s.close()
+            self.data = {}
+            self.next_expiration = None
+        finally:
+            self.lock.release()
+
+
 def _connect(s, address):
     try:
         s.connect(address)
@@ -427,7 +829,7 @@ def _connect(s, address):
 
 
 def tcp(q, where, timeout=None, port=53, af=None, source=None, source_port=0,
-        one_rr_per_rrset=False):
+        one_rr_per_rrset=False, pool=None):
     """Return the response obtained after sending a query via TCP.
 
     *q*, a ``dns.message.message``, the query to send
@@ -454,31 +856,62 @@ def tcp(q, where, timeout=None, port=53, af=None, source=None, source_port=0,
     *one_rr_per_rrset*, a ``bool``.  If ``True``, put each RR into its own
     RRset.
 
+    *pool*, a ``dns.query.ConnectionPool`` or ``None``.  If not ``None``,
+    an idle connection to the server is taken from the pool if one is
+    available, and the connection is returned to the pool for reuse once
+    the response has been received.
+
     Returns a ``dns.message.Message``.
     """
 
-    wire = q.to_wire()
+    wire = _query_wire(q)
     (af, destination, source) = _destination_and_source(af, where, port,
                                                         source, source_port)
+    begin_time = time.time()
+    expiration = _compute_expiration(timeout, begin_time)
+    if pool is not None:
+        s = pool.acquire(af, destination, source)
+        if s is not None:
+            try:
+                send_tcp(s, wire, expiration)
+                (r, received_time) = receive_tcp(s, expiration,
+                                                 one_rr_per_rrset,
+                                                 q.keyring, q.mac)
+            except (EOFError, socket.error):
+                # The server has probably closed the idle connection;
+                # try again with a new one.
+                s.close()
+            except Exception:
+                s.close()
+                raise
+            else:
+                r.time = received_time - begin_time
+                if not q.is_response(r):
+                    s.close()
+                    raise BadResponse
+                pool.release(af, destination, source, s)
+                return r
     s = socket_factory(af, socket.SOCK_STREAM, 0)
-    begin_time = None
     received_time = None
+    reusable = False
     try:
-        expiration = _compute_expiration(timeout)
         s.setblocking(0)
-        begin_time = time.time()
         if source is not None:
             s.bind(source)
         _connect(s, destination)
         send_tcp(s, wire, expiration)
         (r, received_time) = receive_tcp(s, expiration, one_rr_per_rrset,
                                          q.keyring, q.mac)
+        reusable = pool is not None and q.is_response(r)
     finally:
-        if begin_time is None or received_time is None:
+        if received_time is None:
             response_time = 0
         else:
             response_time = received_time - begin_time
-        s.close()
+        if reusable:
+            pool.release(af, destination, source, s)
+        else:
+            s.close()
     r.time = response_time
     if not q.is_response(r):
         raise BadResponse
@@ -571,13 +1004,15 @@ def xfr(where, zone, rdtype=dns.rdatatype.AXFR, rdclass=dns.rdataclass.IN,
         s.bind(source)
     expiration = _compute_expiration(lifetime)
     _connect(s, destination)
-    l = len(wire)
+    _wait_for_writable(s, expiration)
     if use_udp:
-        _wait_for_writable(s, expiration)
         s.send(wire)
     else:
-        tcpmsg = struct.pack("!H", l) + wire
-        _net_write(s, tcpmsg, expiration)
+        _net_write_message(s, wire, expiration)
+        if _have_memoryview:
+            reader = _TCPMessageReader(s)
+        else:
+            reader = None
     done = False
     delete_mode = True
     expecting_SOA = False
@@ -597,9 +1032,11 @@ def xfr(where, zone, rdtype=dns.rdatatype.AXFR, rdclass=dns.rdataclass.IN,
         if use_udp:
             _wait_for_readable(s, expiration)
             (wire, from_address) = s.recvfrom(65535)
+        elif reader is not None:
+            wire = reader.read(mexpiration)
         else:
             ldata = _net_read(s, 2, mexpiration)
-            (l,) = struct.unpack("!H", ldata)
+            (l,) = _tcp_length.unpack(ldata)
             wire = _net_read(s, l, mexpiration)
         is_ixfr = (rdtype == dns.rdatatype.IXFR)
         r = dns.message.from_wire(wire, keyring=q.keyring, request_mac=q.mac,
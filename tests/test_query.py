@@ -0,0 +1,604 @@
+# Copyright (C) 2003-2017 Nominum, Inc.
+#
+# Permission to use, copy, modify, and distribute this software and its
+# documentation for any purpose with or without fee is hereby granted,
+# provided that the above copyright notice and this permission notice
+# appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NOMINUM DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NOMINUM BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT
+# OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import os
+import socket
+try:
+    import ssl
+except ImportError:
+    ssl = None
+import struct
+import threading
+import time
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import dns.exception
+import dns.message
+import dns.name
+import dns.query
+import dns.rrset
+import dns.zone
+
+
+def _read_exactly(sock, count):
+    data = b''
+    while len(data) < count:
+        n = sock.recv(count - len(data))
+        if n == b'':
+            raise EOFError
+        data += n
+    return data
+
+
+class TCPServer(object):
+    """A local TCP DNS server which answers every query it gets with an
+    empty response, counting the connections it accepts.
+    """
+
+    def __init__(self, hangup_after=None):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.hangup_after = hangup_after
+        self.connections = 0
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                (s, _) = self.listener.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            answered = 0
+            try:
+                while answered != self.hangup_after:
+                    (l,) = struct.unpack('!H', _read_exactly(s, 2))
+                    q = dns.message.from_wire(_read_exactly(s, l))
+                    wire = dns.message.make_response(q).to_wire()
+                    s.sendall(struct.pack('!H', len(wire)) + wire)
+                    answered += 1
+            except EOFError:
+                pass
+            s.close()
+
+    def close(self):
+        self.listener.close()
+
+
+class XFRServer(TCPServer):
+    """A local TCP DNS server which answers a single zone transfer request
+    with the records in *messages*, one response message per list of
+    records.  The responses are sent with one write, unless *splits* lists
+    offsets in the data at which to pause between writes.
+    """
+
+    def __init__(self, messages, splits=()):
+        self.messages = messages
+        self.splits = splits
+        super(XFRServer, self).__init__()
+
+    def serve(self):
+        (s, _) = self.listener.accept()
+        (l,) = struct.unpack('!H', _read_exactly(s, 2))
+        q = dns.message.from_wire(_read_exactly(s, l))
+        data = b''
+        for records in self.messages:
+            r = dns.message.make_response(q)
+            for text in records:
+                r.answer.append(dns.rrset.from_text('example.', 300, 'IN',
+                                                    *text.split(' ', 1)))
+            wire = r.to_wire()
+            data += struct.pack('!H', len(wire)) + wire
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        start = 0
+        for end in self.splits:
+            s.sendall(data[start:end])
+            start = end
+            time.sleep(0.05)
+        s.sendall(data[start:])
+        s.close()
+
+
+class XFRTestCase(unittest.TestCase):
+
+    soa = 'SOA ns1.example. hostmaster.example. 1 2 3 4 5'
+
+    def transfer(self, messages, splits=()):
+        server = XFRServer(messages, splits)
+        try:
+            return list(dns.query.xfr('127.0.0.1', 'example.',
+                                      port=server.port, lifetime=5))
+        finally:
+            server.close()
+
+    def testAXFR(self):
+        messages = self.transfer([[self.soa, 'NS ns1.example.'],
+                                  ['A 10.0.0.1'],
+                                  ['TXT "hello"', self.soa]])
+        self.assertEqual(len(messages), 3)
+        z = dns.zone.from_xfr(iter(messages))
+        self.assertEqual(z.find_rdataset('@', 'A')[0].address, '10.0.0.1')
+
+    def testAXFRSplitAcrossReads(self):
+        # The first message is 92 bytes long, with its length prefix;
+        # split the next message's length prefix, and then its body.
+        messages = self.transfer([[self.soa, 'NS ns1.example.'],
+                                  ['A 10.0.0.1'],
+                                  [self.soa]],
+                                 splits=(93, 110))
+        self.assertEqual(len(messages), 3)
+        z = dns.zone.from_xfr(iter(messages))
+        self.assertEqual(z.find_rdataset('@', 'A')[0].address, '10.0.0.1')
+
+    def testLongAXFR(self):
+        # Much more data than the reader's buffer holds, so unread data
+        # has to be moved to the front of the buffer along the way.
+        strings = ' '.join(['"%s"' % ('x' * 250)] * 100)
+        messages = [[self.soa, 'NS ns1.example.']]
+        for i in range(12):
+            messages.append(['TXT "%d" %s' % (i, strings)])
+        messages.append([self.soa])
+        received = self.transfer(messages, splits=(1000, 100000))
+        self.assertEqual(len(received), 14)
+        z = dns.zone.from_xfr(iter(received))
+        self.assertEqual(len(z.find_rdataset('@', 'TXT')), 12)
+
+    def testAXFRWithoutMemoryview(self):
+        # Without memoryview (Python 2.6) messages are read one at a time.
+        saved = dns.query._have_memoryview
+        dns.query._have_memoryview = False
+        try:
+            self.testAXFRSplitAcrossReads()
+        finally:
+            dns.query._have_memoryview = saved
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = dns.query.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close_idle()
+
+    def testTCPReusesConnection(self):
+        server = TCPServer()
+        try:
+            for _ in range(3):
+                q = dns.message.make_query('www.dnspython.org.', 'A')
+                r = dns.query.tcp(q, '127.0.0.1', timeout=2,
+                                  port=server.port, pool=self.pool)
+                self.assertTrue(q.is_response(r))
+            self.assertEqual(server.connections, 1)
+        finally:
+            server.close()
+
+    def testTCPWithoutPoolDoesNotReuse(self):
+        server = TCPServer()
+        try:
+            for _ in range(2):
+                q = dns.message.make_query('www.dnspython.org.', 'A')
+                dns.query.tcp(q, '127.0.0.1', timeout=2, port=server.port)
+            self.assertEqual(server.connections, 2)
+        finally:
+            server.close()
+
+    def testTCPReconnectsWhenServerHangsUp(self):
+        server = TCPServer(hangup_after=1)
+        try:
+            for _ in range(2):
+                q = dns.message.make_query('www.dnspython.org.', 'A')
+                r = dns.query.tcp(q, '127.0.0.1', timeout=2,
+                                  port=server.port, pool=self.pool)
+                self.assertTrue(q.is_response(r))
+            self.assertEqual(server.connections, 2)
+        finally:
+            server.close()
+
+    def testIdleConnectionsExpire(self):
+        a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            destination = ('127.0.0.1', 53)
+            self.pool.max_idle = 0
+            self.pool.release(socket.AF_INET, destination, None, a)
+            self.assertTrue(self.pool.acquire(socket.AF_INET,
+                                              destination) is None)
+        finally:
+            a.close()
+
+    def testOnlyExpiredConnectionsAreClosed(self):
+        a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        b = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            destination = ('127.0.0.1', 53)
+            self.pool.max_idle = 0
+            self.pool.release(socket.AF_INET, destination, None, a)
+            self.pool.max_idle = 3600
+            self.pool.release(socket.AF_INET, destination, None, b)
+            self.assertTrue(self.pool.acquire(socket.AF_INET,
+                                              destination) is b)
+            self.assertTrue(self.pool.acquire(socket.AF_INET,
+                                              destination) is None)
+            self.assertEqual(self.pool.data, {})
+        finally:
+            a.close()
+            b.close()
+
+    def testAcquireMatchesDestination(self):
+        a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            destination = ('127.0.0.1', 53)
+            self.pool.release(socket.AF_INET, destination, None, a)
+            self.assertTrue(self.pool.acquire(socket.AF_INET,
+                                              ('127.0.0.1', 5353)) is None)
+            self.assertTrue(self.pool.acquire(socket.AF_INET,
+                                              destination) is a)
+        finally:
+            a.close()
+
+
+@unittest.skipUnless(hasattr(socket, 'socketpair'), 'requires socketpair()')
+class TCPFramingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        (self.a, self.b) = socket.socketpair()
+        self.a.setblocking(0)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def testSendTCP(self):
+        q = dns.message.make_query('www.dnspython.org.', 'A')
+        wire = q.to_wire()
+        (n, _) = dns.query.send_tcp(self.a, q)
+        self.assertEqual(n, len(wire) + 2)
+        self.assertEqual(_read_exactly(self.b, n),
+                         struct.pack('!H', len(wire)) + wire)
+
+    def testSendTCPLongMessage(self):
+        # Shrink the buffers so that the first send is a short write.
+        self.a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.b.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        wire = b'\x00' * 65535
+        received = []
+        reader = threading.Thread(
+            target=lambda: received.append(_read_exactly(self.b, 65537)))
+        reader.start()
+        (n, _) = dns.query.send_tcp(self.a, wire, expiration=None)
+        reader.join()
+        self.assertEqual(n, 65537)
+        self.assertEqual(received[0], b'\xff\xff' + wire)
+
+    def testReceiveTCPLongMessage(self):
+        # Shrink the buffers so that the message arrives in many reads.
+        self.a.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.b.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        q = dns.message.make_query('www.dnspython.org.', 'A')
+        response = dns.message.make_response(q)
+        response.answer.append(dns.rrset.from_text_list(
+            'www.dnspython.org.', 300, 'IN', 'TXT',
+            ['"%d%s"' % (i, 'x' * 240) for i in range(200)]))
+        wire = response.to_wire()
+        writer = threading.Thread(
+            target=self.b.sendall,
+            args=(struct.pack('!H', len(wire)) + wire,))
+        writer.start()
+        (r, _) = dns.query.receive_tcp(self.a, time.time() + 2)
+        writer.join()
+        self.assertEqual(r, response)
+
+
+# A self-signed certificate and its key, for "localhost".
+tls_pem = os.path.join(os.path.dirname(__file__), 'tls.pem')
+
+
+@unittest.skipIf(ssl is None, 'requires ssl')
+class TLSTestCase(unittest.TestCase):
+    """Tests using a TLS-wrapped client socket, which refuses the flags and
+    gather writes used with plain sockets, against a local TLS DNS server
+    which answers one query.
+    """
+
+    def setUp(self):
+        server_context = ssl.SSLContext(
+            getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        server_context.load_cert_chain(tls_pem)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.thread = threading.Thread(target=self.serve,
+                                       args=(server_context,))
+        self.thread.daemon = True
+        self.thread.start()
+        client_context = ssl.create_default_context(cafile=tls_pem)
+        self.sock = client_context.wrap_socket(
+            socket.create_connection(self.listener.getsockname()),
+            server_hostname='localhost')
+
+    def tearDown(self):
+        self.sock.close()
+        self.listener.close()
+        self.thread.join()
+
+    def serve(self, context):
+        (s, _) = self.listener.accept()
+        s = context.wrap_socket(s, server_side=True)
+        try:
+            (l,) = struct.unpack('!H', _read_exactly(s, 2))
+            q = dns.message.from_wire(_read_exactly(s, l))
+            wire = dns.message.make_response(q).to_wire()
+            s.sendall(struct.pack('!H', len(wire)) + wire)
+        except (EOFError, socket.error):
+            pass
+        s.close()
+
+    def read_response(self):
+        (l,) = struct.unpack('!H', _read_exactly(self.sock, 2))
+        return dns.message.from_wire(_read_exactly(self.sock, l))
+
+    def testNetWrite(self):
+        q = dns.message.make_query('www.dnspython.org.', 'A')
+        wire = q.to_wire()
+        dns.query._net_write(self.sock, struct.pack('!H', len(wire)) + wire,
+                             time.time() + 2)
+        self.assertTrue(q.is_response(self.read_response()))
+
+    def testReceiveTCP(self):
+        q = dns.message.make_query('www.dnspython.org.', 'A')
+        wire = q.to_wire()
+        self.sock.sendall(struct.pack('!H', len(wire)) + wire)
+        (r, _) = dns.query.receive_tcp(self.sock, time.time() + 2)
+        self.assertTrue(q.is_response(r))
+
+    def testSendTCP(self):
+        q = dns.message.make_query('www.dnspython.org.', 'A')
+        (n, _) = dns.query.send_tcp(self.sock, q, time.time() + 2)
+        self.assertEqual(n, len(q.to_wire()) + 2)
+        self.assertTrue(q.is_response(self.read_response()))
+
+
+class QueryWireTestCase(unittest.TestCase):
+
+    def setUp(self):
+        dns.query._query_wire_cache.clear()
+
+    def testCachedWireHasOwnID(self):
+        for _ in range(3):
+            q = dns.message.make_query('www.dnspython.org.', 'A',
+                                       use_edns=0)
+            self.assertEqual(dns.query._query_wire(q), q.to_wire())
+        self.assertEqual(len(dns.query._query_wire_cache), 1)
+
+    def testCaseIsPreserved(self):
+        for name in ('www.dnspython.org.', 'WwW.DnSpYtHoN.OrG.'):
+            q = dns.message.make_query(name, 'A')
+            self.assertEqual(dns.query._query_wire(q), q.to_wire())
+        self.assertEqual(len(dns.query._query_wire_cache), 2)
+
+    def testDifferentQuestions(self):
+        for rdtype in ('A', 'AAAA'):
+            q = dns.message.make_query('www.dnspython.org.', rdtype)
+            self.assertEqual(dns.query._query_wire(q), q.to_wire())
+        q = dns.message.make_query('www.dnspython.org.', 'A')
+        q.flags = 0
+        self.assertEqual(dns.query._query_wire(q), q.to_wire())
+        self.assertEqual(len(dns.query._query_wire_cache), 3)
+
+    def testSignedQueriesAreNotCached(self):
+        keyname = dns.name.from_text('keyname.')
+        q = dns.message.make_query('www.dnspython.org.', 'A')
+        q.use_tsig({keyname: b'0123456789abcdef'}, keyname)
+        dns.query._query_wire(q)
+        self.assertEqual(len(dns.query._query_wire_cache), 0)
+
+
+class FloodSocket(object):
+    """A UDP socket stand-in which always has another datagram from an
+    unexpected source ready to be read.
+    """
+
+    def __init__(self, sock, wire):
+        self.sock = sock
+        self.family = sock.family
+        self.wire = wire
+        self.give_up = time.time() + 5
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recvfrom(self, bufsize, flags=0):
+        if time.time() > self.give_up:
+            raise RuntimeError('receive_udp() did not time out')
+        return (self.wire, ('127.0.0.2', 53))
+
+
+class NoFlagsSocket(object):
+    """A UDP socket stand-in which, like some socket wrappers, refuses
+    any flags to recvfrom().
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.family = sock.family
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recvfrom(self, bufsize, *flags):
+        if flags:
+            raise ValueError('non-zero flags not allowed')
+        return self.sock.recvfrom(bufsize)
+
+
+class UDPTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sockets = []
+        self.receiver = self.udp_socket()
+        self.receiver.setblocking(0)
+        self.server = self.udp_socket()
+
+    def tearDown(self):
+        for s in self.sockets:
+            s.close()
+
+    def udp_socket(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(('127.0.0.1', 0))
+        self.sockets.append(s)
+        return s
+
+    def response_wire(self):
+        q = dns.message.make_query('www.dnspython.org.', 'A')
+        return (q, dns.message.make_response(q).to_wire())
+
+    def testSendUDP(self):
+        (_, wire) = self.response_wire()
+        (n, _) = dns.query.send_udp(self.server, wire,
+                                    self.receiver.getsockname(),
+                                    expiration=time.time() + 2)
+        self.assertEqual(n, len(wire))
+        self.assertEqual(self.receiver.recv(65535), wire)
+
+    def testReceiveUDP(self):
+        (q, wire) = self.response_wire()
+        self.server.sendto(wire, self.receiver.getsockname())
+        (r, _) = dns.query.receive_udp(self.receiver,
+                                       self.server.getsockname(),
+                                       expiration=time.time() + 2)
+        self.assertTrue(q.is_response(r))
+
+    @unittest.skipUnless(socket.has_ipv6, 'requires IPv6')
+    def testReceiveUDPOtherAddressText(self):
+        try:
+            receiver = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            self.sockets.append(receiver)
+            receiver.bind(('::1', 0))
+            server = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            self.sockets.append(server)
+            server.bind(('::1', 0))
+        except socket.error:
+            self.skipTest('no IPv6 loopback')
+        (q, wire) = self.response_wire()
+        server.sendto(wire, receiver.getsockname())
+        destination = ('0:0::0:1', server.getsockname()[1], 0, 0)
+        (r, _) = dns.query.receive_udp(receiver, destination,
+                                       expiration=time.time() + 2)
+        self.assertTrue(q.is_response(r))
+
+    def testReceiveUDPUnexpectedSource(self):
+        (_, wire) = self.response_wire()
+        self.udp_socket().sendto(wire, self.receiver.getsockname())
+        self.assertRaises(dns.query.UnexpectedSource,
+                          dns.query.receive_udp, self.receiver,
+                          self.server.getsockname(),
+                          expiration=time.time() + 2)
+
+    def testReceiveUDPIgnoresUnexpectedSources(self):
+        (q, wire) = self.response_wire()
+        other = self.udp_socket()
+        for _ in range(3):
+            other.sendto(wire, self.receiver.getsockname())
+        self.server.sendto(wire, self.receiver.getsockname())
+        (r, _) = dns.query.receive_udp(self.receiver,
+                                       self.server.getsockname(),
+                                       expiration=time.time() + 2,
+                                       ignore_unexpected=True)
+        self.assertTrue(q.is_response(r))
+
+    def testReceiveUDPWaitsAfterUnexpectedSources(self):
+        (q, wire) = self.response_wire()
+        self.udp_socket().sendto(wire, self.receiver.getsockname())
+        timer = threading.Timer(0.1, self.server.sendto,
+                                (wire, self.receiver.getsockname()))
+        timer.start()
+        (r, _) = dns.query.receive_udp(self.receiver,
+                                       self.server.getsockname(),
+                                       expiration=time.time() + 2,
+                                       ignore_unexpected=True)
+        timer.join()
+        self.assertTrue(q.is_response(r))
+
+    def testReceiveUDPSocketRefusingFlags(self):
+        (q, wire) = self.response_wire()
+        self.udp_socket().sendto(wire, self.receiver.getsockname())
+        self.server.sendto(wire, self.receiver.getsockname())
+        (r, _) = dns.query.receive_udp(NoFlagsSocket(self.receiver),
+                                       self.server.getsockname(),
+                                       expiration=time.time() + 2,
+                                       ignore_unexpected=True)
+        self.assertTrue(q.is_response(r))
+
+    def testReceiveUDPExpectedID(self):
+        (q, wire) = self.response_wire()
+        self.server.sendto(wire, self.receiver.getsockname())
+        (r, _) = dns.query.receive_udp(self.receiver,
+                                       self.server.getsockname(),
+                                       expiration=time.time() + 2,
+                                       expected_id=q.id)
+        self.assertTrue(q.is_response(r))
+
+    def testReceiveUDPUnexpectedID(self):
+        (q, wire) = self.response_wire()
+        self.server.sendto(wire, self.receiver.getsockname())
+        self.assertRaises(dns.query.BadResponse,
+                          dns.query.receive_udp, self.receiver,
+                          self.server.getsockname(),
+                          expiration=time.time() + 2,
+                          expected_id=(q.id + 1) % 65536)
+
+    def testReceiveUDPIgnoresUnexpectedIDs(self):
+        (q, wire) = self.response_wire()
+        other_id = struct.pack('!H', (q.id + 1) % 65536)
+        not_response = wire[:2] + b'\x00' + wire[3:]
+        for bad in (b'\x00', other_id + wire[2:], not_response):
+            self.server.sendto(bad, self.receiver.getsockname())
+        self.server.sendto(wire, self.receiver.getsockname())
+        (r, _) = dns.query.receive_udp(self.receiver,
+                                       self.server.getsockname(),
+                                       expiration=time.time() + 2,
+                                       ignore_unexpected=True,
+                                       expected_id=q.id)
+        self.assertTrue(q.is_response(r))
+
+    def testReceiveUDPTimesOutDuringFlood(self):
+        (_, wire) = self.response_wire()
+        # Leave a datagram queued so that the socket always polls readable.
+        self.udp_socket().sendto(wire, self.receiver.getsockname())
+        flood = FloodSocket(self.receiver, wire)
+        start = time.time()
+        self.assertRaises(dns.exception.Timeout,
+                          dns.query.receive_udp, flood,
+                          self.server.getsockname(),
+                          expiration=start + 0.2, ignore_unexpected=True)
+        self.assertTrue(time.time() - start < 1)
+
+    def testReceiveUDPTimeout(self):
+        self.assertRaises(dns.exception.Timeout,
+                          dns.query.receive_udp, self.receiver,
+                          self.server.getsockname(),
+                          expiration=time.time() + 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
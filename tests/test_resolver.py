@@ -23,8 +23,11 @@ try:
 except ImportError:
     import unittest
 
+import dns.flags
 import dns.message
 import dns.name
+import dns.query
+import dns.rdata
 import dns.rdataclass
 import dns.rdatatype
 import dns.resolver
@@ -424,5 +427,44 @@ class NXDOMAINExceptionTestCase(unittest.TestCase):
         self.assertTrue(e2.canonical_name == dns.name.from_text(cname2))
 
 
+class QueryFunctionsTestCase(unittest.TestCase):
+    """The resolver sends its queries through the public dns.query
+    functions, so that wrapping or replacing them affects it."""
+
+    def setUp(self):
+        self.udp = dns.query.udp
+        self.tcp = dns.query.tcp
+        self.calls = []
+
+    def tearDown(self):
+        dns.query.udp = self.udp
+        dns.query.tcp = self.tcp
+
+    def fake_udp(self, q, where, *args, **kwargs):
+        self.calls.append(('udp', where))
+        r = dns.message.make_response(q)
+        r.flags |= dns.flags.TC
+        return r
+
+    def fake_tcp(self, q, where, *args, **kwargs):
+        self.calls.append(('tcp', where))
+        r = dns.message.make_response(q)
+        rrset = r.find_rrset(r.answer, q.question[0].name,
+                             dns.rdataclass.IN, dns.rdatatype.A, create=True)
+        rrset.add(dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.A,
+                                       '10.0.0.1'), 300)
+        return r
+
+    def testTruncatedResponseFallsBackToTCP(self):
+        dns.query.udp = self.fake_udp
+        dns.query.tcp = self.fake_tcp
+        res = dns.resolver.Resolver(configure=False)
+        res.nameservers = ['192.0.2.1']
+        answer = res.query('www.dnspython.org.', 'A')
+        self.assertEqual(answer[0].address, '10.0.0.1')
+        self.assertEqual(self.calls, [('udp', '192.0.2.1'),
+                                      ('tcp', '192.0.2.1')])
+
+
 if __name__ == '__main__':
     unittest.main()